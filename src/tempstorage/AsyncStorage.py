@@ -0,0 +1,133 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" An asyncio facade over a TemporaryStorage
+
+Every TemporaryStorage call takes the storage lock and may have to wait for
+a commit (including its garbage collection) to finish.  The facade runs
+those calls in worker threads so that the event loop is never blocked on the
+storage lock.  Reads run in a bounded pool and concurrent reads of the same
+object are coalesced into a single call; commits run one at a time in a
+thread of their own, since the storage serializes them anyway, so that a
+queue of commits can not starve reads of workers.
+
+A facade must only be used from a single event loop.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from ZODB.Connection import TransactionMetaData
+
+
+# number of worker threads used for reads
+ASYNC_READ_WORKERS = 4
+
+
+class AsyncTemporaryStorage:
+
+    def __init__(self, storage, read_workers=ASYNC_READ_WORKERS):
+        """
+        _storage -- the wrapped storage
+
+        _read_executor -- bounded pool running loads
+
+        _commit_executor -- single thread running commits
+
+        _pending -- mapping, read key => future of the running read
+        """
+        self._storage = storage
+        self._read_executor = ThreadPoolExecutor(
+            read_workers, thread_name_prefix='tempstorage-read')
+        self._commit_executor = ThreadPoolExecutor(
+            1, thread_name_prefix='tempstorage-commit')
+        self._pending = {}
+
+    async def close(self):
+        """ Stop the worker threads; the wrapped storage is left open
+
+        Waiting for running reads and commits to finish happens in a
+        thread, so that closing does not block the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._shutdown)
+
+    def _shutdown(self):
+        self._read_executor.shutdown(wait=True)
+        self._commit_executor.shutdown(wait=True)
+
+    async def _coalesce(self, key, func, *args):
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._read_executor, func, *args)
+            self._pending[key] = future
+
+            def done(f):
+                if self._pending.get(key) is f:
+                    del self._pending[key]
+
+            future.add_done_callback(done)
+        # shield the shared read from the cancellation of a single waiter
+        return await asyncio.shield(future)
+
+    async def load(self, oid):
+        """ Return (pickle, serial) for the current revision of oid
+        """
+        return await self._coalesce(('load', oid), self._storage.load, oid)
+
+    async def loadBefore(self, oid, tid):
+        """ Return (pickle, start tid, end tid) for the revision of oid
+        committed before tid, or None (see TemporaryStorage.loadBefore)
+        """
+        return await self._coalesce(
+            ('loadBefore', oid, tid), self._storage.loadBefore, oid, tid)
+
+    async def new_oid(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._read_executor, self._storage.new_oid)
+
+    def _commit(self, records, user, description):
+        storage = self._storage
+        t = TransactionMetaData(user, description)
+        storage.tpc_begin(t)
+        try:
+            for oid, serial, data in records:
+                storage.store(oid, serial, data, '', t)
+            storage.tpc_vote(t)
+            return storage.tpc_finish(t)
+        except:  # noqa: E722 bare except
+            storage.tpc_abort(t)
+            raise
+
+    async def commit(self, records, user='', description=''):
+        """ Store (oid, serial, pickle) records in one transaction
+
+        Returns the tid of the committed transaction.  Conflict errors
+        raised by the storage are propagated to the caller.
+        """
+        records = list(records)
+        loop = asyncio.get_running_loop()
+        tid = await loop.run_in_executor(
+            self._commit_executor, self._commit, records, user, description)
+        # reads started before the commit finished must not be shared with
+        # callers that ask after it
+        oids = {oid for oid, serial, data in records}
+        for key in [key for key in self._pending if key[1] in oids]:
+            del self._pending[key]
+        return tid
+
+    async def store(self, oid, serial, data, user='', description=''):
+        """ Store a single object in its own transaction; returns the tid
+        """
+        return await self.commit([(oid, serial, data)], user, description)
@@ -19,15 +19,32 @@ resolution.
 This is a ripoff of Jim's Packless bsddb3 storage.
 """
 import bisect
+import copy
+import heapq
+import logging
 import time
+from collections import OrderedDict
+from collections import deque
+from io import BytesIO
 
 from ZODB import POSException
+from ZODB._compat import PersistentPickler
+from ZODB._compat import PersistentUnpickler
+from ZODB._compat import _protocol
 from ZODB.BaseStorage import BaseStorage
+from ZODB.ConflictResolution import BadClassName
 from ZODB.ConflictResolution import ConflictResolvingStorage
+from ZODB.ConflictResolution import PersistentReferenceFactory
+from ZODB.ConflictResolution import find_global
+from ZODB.ConflictResolution import persistent_id
+from ZODB.ConflictResolution import state
 from ZODB.serialize import referencesf
+from ZODB.utils import get_pickle_metadata
 from ZODB.utils import z64
 
 
+logger = logging.getLogger('ZODB.ConflictResolution')
+
 # keep old object revisions for CONFLICT_CACHE_MAXAGE seconds
 CONFLICT_CACHE_MAXAGE = 60
 
@@ -37,6 +54,23 @@ CONFLICT_CACHE_GCEVERY = 60
 # keep history of recently gc'ed oids of length RECENTLY_GC_OIDS_LEN
 RECENTLY_GC_OIDS_LEN = 200
 
+# remember the oids changed by the last RECENT_INVALIDATIONS_LEN transactions
+RECENT_INVALIDATIONS_LEN = 100
+
+# examine OBJECT_STATISTICS_BATCH objects per lock acquisition when
+# computing object statistics
+OBJECT_STATISTICS_BATCH = 1000
+
+# keep the unpickled states of the last CONFLICT_RESOLUTION_CACHE_SIZE object
+# revisions involved in conflicts, and as many resolution outcomes
+CONFLICT_RESOLUTION_CACHE_SIZE = 100
+
+
+def _seenBy(tid, serial, end):
+    # Does a reader at 'tid' see the revision committed by 'serial' and
+    # replaced or deleted by 'end'?
+    return serial <= tid < end
+
 
 class ReferenceCountError(POSException.POSError):
     """ Error while decrementing a reference to an object in the commit phase.
@@ -54,10 +88,148 @@ class TemporaryStorageError(POSException.POSError):
     """
 
 
+class ConflictResolutionCache:
+    """ Bounded LRU cache of object states used for conflict resolution
+
+    Writers conflicting on a hot object are resolved against the same
+    committed state, and often started from the same old state.  The cache
+    keeps the unpickled states of recent revisions, keyed by (oid, serial),
+    so that they are unpickled only once.  Resolvers may modify the states
+    they are given, so every use gets a copy.  All states of an oid are
+    unpickled with the same PersistentReferenceFactory, so that references
+    to the same object are the same PersistentReference, as they are
+    within a single resolution.
+
+    As a second step, outcomes are remembered by (oid, committed serial,
+    old serial, new pickle): the resolved pickle, or the (class, args,
+    attributes) of the ConflictError raised if the conflict could not be
+    resolved.  This answers a retry sending the very same state.
+
+    At most 'size' states and 'size' outcomes are kept.  A size of 0
+    disables the cache.
+    """
+
+    def __init__(self, size=CONFLICT_RESOLUTION_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.outcome_hits = 0
+        self.outcome_misses = 0
+        self._oids = OrderedDict()  # oid => (factory, {serial: state})
+        self._nstates = 0
+        self._outcomes = OrderedDict()
+
+    def __len__(self):
+        return self._nstates
+
+    def factory(self, oid):
+        """ Return the PersistentReferenceFactory to unpickle oid's states
+        """
+        entry = self._oids.get(oid)
+        if entry is None:
+            return PersistentReferenceFactory()
+        return entry[0]
+
+    def getState(self, oid, serial, default=None):
+        """ Return a copy of the cached state of revision serial of oid
+        """
+        entry = self._oids.get(oid)
+        if entry is None or serial not in entry[1]:
+            self.misses += 1
+            return default
+        self._oids.move_to_end(oid)
+        self.hits += 1
+        return self._copy(entry[0], entry[1][serial])
+
+    def putState(self, oid, serial, factory, state):
+        """ Remember a state unpickled with factory; return a copy of it
+        """
+        if self.size <= 0:
+            return state
+        entry = self._oids.get(oid)
+        if entry is None or entry[0] is not factory:
+            if entry is not None:
+                self._nstates -= len(entry[1])
+            entry = self._oids[oid] = (factory, {})
+        if serial not in entry[1]:
+            self._nstates += 1
+        entry[1][serial] = state
+        self._oids.move_to_end(oid)
+        while self._nstates > self.size:
+            # drop the oldest state of the least recently used oid
+            lru_oid, (lru_factory, states) = next(iter(self._oids.items()))
+            del states[next(iter(states))]
+            self._nstates -= 1
+            if not states:
+                del self._oids[lru_oid]
+        return self._copy(factory, state)
+
+    def _copy(self, factory, state):
+        # PersistentReferences can't be copied, and needn't be: share them
+        memo = {id(ref): ref for ref in (factory.data or {}).values()}
+        return copy.deepcopy(state, memo)
+
+    def getOutcome(self, key, default=None):
+        try:
+            value = self._outcomes[key]
+        except KeyError:
+            self.outcome_misses += 1
+            return default
+        self._outcomes.move_to_end(key)
+        self.outcome_hits += 1
+        return value
+
+    def putOutcome(self, key, value):
+        if self.size <= 0:
+            return
+        self._outcomes[key] = value
+        self._outcomes.move_to_end(key)
+        while len(self._outcomes) > self.size:
+            self._outcomes.popitem(last=False)
+
+
+class Snapshot:
+    """ A consistent view of a TemporaryStorage as of a pinned tid
+
+    While the snapshot is held, the object revisions it can see are kept
+    even when they expire from the storage's conflict cache or the objects
+    are garbage collected.  Release it as soon as it is no longer needed;
+    it can also be used as a context manager.
+    """
+
+    def __init__(self, storage, tid):
+        self._storage = storage
+        self.tid = tid
+        self._released = False
+
+    def load(self, oid):
+        """ Return (pickle, serial) for oid as of the snapshot's tid
+        """
+        if self._released:
+            raise TemporaryStorageError('Snapshot has been released')
+        return self._storage._loadPinned(oid, self.tid)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._storage._unpin(self.tid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
 class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
 
-    def __init__(self, name='TemporaryStorage'):
+    def __init__(self, name='TemporaryStorage', resolution_cache=None,
+                 resolution_cache_size=CONFLICT_RESOLUTION_CACHE_SIZE):
         """
+        'resolution_cache' replaces the conflict resolution cache; it must
+        provide the ConflictResolutionCache API.  Otherwise a cache holding
+        'resolution_cache_size' states is used, 0 disables it.
+
         _index -- mapping, oid => current serial
 
         _referenceCount -- mapping, oid => count
@@ -74,6 +246,22 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
 
         _recently_gc_oids -- a queue of recently GC'ed oids
 
+        _invalidations -- bounded queue of (tid, changed oids) for the most
+                          recently committed transactions, oldest first
+
+        _invalidations_floor -- tid of the newest transaction whose changes
+                                were dropped from _invalidations
+
+        _resolution_cache -- cache of states and outcomes of recent conflict
+                             resolutions
+
+        _pins -- mapping, tid pinned by snapshots => number of snapshots
+
+        _pinned_revisions -- mapping, oid => list of (serial, end, pickle)
+                             of revisions dropped from the conflict cache
+                             but still seen by snapshots; 'end' is the tid
+                             that replaced or deleted the revision
+
         _oid -- ???
 
         _ltid -- serial of last committed transaction (required by ZEO)
@@ -93,6 +281,13 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
         self._conflict_cache = {}
         self._last_cache_gc = 0
         self._recently_gc_oids = [None for x in range(RECENTLY_GC_OIDS_LEN)]
+        self._invalidations = deque(maxlen=RECENT_INVALIDATIONS_LEN)
+        self._invalidations_floor = z64
+        if resolution_cache is None:
+            resolution_cache = ConflictResolutionCache(resolution_cache_size)
+        self._resolution_cache = resolution_cache
+        self._pins = {}
+        self._pinned_revisions = {}
         self._oid = z64
         self._ltid = z64
 
@@ -105,9 +300,246 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
         """
         return self._ltid
 
+    def lastInvalidations(self, size):
+        """ Return the oids changed by the last 'size' transactions (for ZEO)
+
+        The result is a list of (tid, oids) tuples, oldest transaction first.
+        Fewer than 'size' entries are returned if the storage doesn't
+        remember that many transactions.
+        """
+        with self._lock:
+            if size <= 0:
+                return []
+            return [(tid, list(oids))
+                    for tid, oids in list(self._invalidations)[-size:]]
+
+    def getInvalidations(self, tid):
+        """ Return the oids changed by transactions committed after 'tid'
+
+        The result is a (last tid, oids) tuple which lets a reconnecting
+        client invalidate only the objects that changed while it was away.
+        None is returned if 'tid' is older than the oldest transaction
+        remembered by the storage; the client must then invalidate its
+        whole cache.
+        """
+        with self._lock:
+            ltid = self._ltid
+            if tid >= ltid:
+                return ltid, []
+            if tid < self._invalidations_floor:
+                # changes committed after tid may already be forgotten
+                return None
+            oids = {}
+            for itid, ioids in self._invalidations:
+                if itid > tid:
+                    for oid in ioids:
+                        oids[oid] = 1
+            return ltid, list(oids)
+
     def __len__(self):
         return len(self._index)
 
+    def snapshot(self):
+        """ Pin the last committed transaction for reading
+
+        Returns a Snapshot whose 'load' sees the objects as of its 'tid'.
+        'loadBefore' sees them too, so a connection opened with
+        DB.open(at=snapshot.tid) reads the snapshot's objects.
+
+        Pinning copies nothing: the revisions a snapshot sees stay where
+        they are until the storage would otherwise forget them, and are set
+        aside for the snapshot then.  Only the last committed transaction
+        can be pinned, since older revisions may already be forgotten.
+        """
+        with self._lock:
+            tid = self._ltid
+            self._pins[tid] = self._pins.get(tid, 0) + 1
+            return Snapshot(self, tid)
+
+    def _unpin(self, tid):
+        with self._lock:
+            count = self._pins[tid] - 1
+            if count:
+                self._pins[tid] = count
+            else:
+                del self._pins[tid]
+            # forget revisions no snapshot sees anymore
+            for oid, revisions in list(self._pinned_revisions.items()):
+                kept = [(serial, end, data)
+                        for serial, end, data in revisions
+                        if self._pinnedBetween(serial, end)]
+                if kept:
+                    self._pinned_revisions[oid] = kept
+                else:
+                    del self._pinned_revisions[oid]
+
+    def _pinnedBetween(self, serial, end):
+        # Is a snapshot pinned at or after the revision 'serial' but before
+        # 'end', the tid which replaced or deleted it?
+        for tid in self._pins:
+            if _seenBy(tid, serial, end):
+                return True
+        return False
+
+    def _forgetRevision(self, oid, serial, end, data):
+        # Drop a revision from the conflict cache, setting it aside if a
+        # snapshot still sees it.
+        if self._pins and self._pinnedBetween(serial, end):
+            self._pinned_revisions.setdefault(oid, []).append(
+                (serial, end, data))
+
+    def _loadPinned(self, oid, tid):
+        with self._lock:
+            serial = self._index.get(oid)
+            if serial is not None and serial <= tid:
+                return self._opickle[oid], serial
+            for serial, end, data in self._pinned_revisions.get(oid, ()):
+                if _seenBy(tid, serial, end):
+                    return data, serial
+            # The object changed after tid, recently enough that the
+            # revision seen by tid is still in the conflict cache.
+            serials = [
+                sserial for soid, sserial in self._conflict_cache
+                if soid == oid and sserial <= tid]
+            if not serials:
+                raise POSException.POSKeyError(oid)
+            serial = max(serials)
+            return self._conflict_cache[(oid, serial)][0], serial
+
+    def getPinnedStatistics(self):
+        """ Report what the snapshots currently held cost
+
+        Returns a mapping with these keys:
+
+        pins -- mapping, pinned tid => number of snapshots
+
+        revisions, bytes -- number and size of the object revisions kept
+                            only because snapshots see them
+
+        bytes_by_tid -- mapping, pinned tid => size of the kept revisions
+                        seen by snapshots of that tid (revisions shared
+                        by several tids are counted for each of them)
+        """
+        with self._lock:
+            held = [(serial, end, len(data))
+                    for revisions in self._pinned_revisions.values()
+                    for serial, end, data in revisions]
+            bytes_by_tid = {}
+            for tid in self._pins:
+                bytes_by_tid[tid] = sum(
+                    size for serial, end, size in held
+                    if _seenBy(tid, serial, end))
+            return {
+                'pins': dict(self._pins),
+                'revisions': len(held),
+                'bytes': sum(size for serial, end, size in held),
+                'bytes_by_tid': bytes_by_tid,
+            }
+
+    def getConflictResolutionStatistics(self):
+        """ Report how well the conflict resolution cache works
+
+        hits, misses, size -- lookups and number of cached object states
+
+        outcome_hits, outcome_misses, outcomes -- lookups and number of
+                                                  cached resolution outcomes
+        """
+        with self._lock:
+            cache = self._resolution_cache
+            return {
+                'hits': cache.hits,
+                'misses': cache.misses,
+                'size': len(cache),
+                'outcome_hits': cache.outcome_hits,
+                'outcome_misses': cache.outcome_misses,
+                'outcomes': len(cache._outcomes),
+            }
+
+    def getObjectStatistics(self, top=10, batch=OBJECT_STATISTICS_BATCH):
+        """ Summarize which objects and classes hold the storage's memory
+
+        The storage lock is only held while examining 'batch' objects at a
+        time, so this can be called on a live storage without stalling
+        commits for long.  Objects removed in the meantime are skipped.
+
+        Returns a mapping with these keys:
+
+        count, bytes -- number of objects and total size of their pickles
+
+        size_histogram -- mapping, size bound => number of objects whose
+                          pickle is smaller than the bound (a power of two)
+
+        largest -- the 'top' largest objects as (size, oid, class name)
+                   tuples, largest first
+
+        classes -- mapping, class name => (object count, bytes)
+
+        refcounts -- mapping, reference count => number of objects
+
+        revisions -- mapping, number of revisions in the conflict
+                     cache => number of objects
+
+        most_revised -- the 'top' objects with the most revisions in the
+                        conflict cache as (revisions, oid) tuples,
+                        most revised first
+
+        Class names are read from the pickle's class header; object state
+        is never unpickled.
+        """
+        count = nbytes = 0
+        size_histogram = {}
+        largest = []
+        classes = {}
+        refcounts = {}
+
+        with self._lock:
+            oids = list(self._opickle)
+        for start in range(0, len(oids), batch):
+            with self._lock:
+                opickle = self._opickle
+                referenceCount = self._referenceCount
+                for oid in oids[start:start + batch]:
+                    data = opickle.get(oid)
+                    if data is None:
+                        continue
+                    rc = referenceCount.get(oid, 0)
+                    size = len(data)
+                    modname, classname = get_pickle_metadata(data)
+                    count += 1
+                    nbytes += size
+                    bound = 1 << size.bit_length()
+                    size_histogram[bound] = size_histogram.get(bound, 0) + 1
+                    refcounts[rc] = refcounts.get(rc, 0) + 1
+                    name = '%s.%s' % (modname, classname)
+                    ccount, cbytes = classes.get(name, (0, 0))
+                    classes[name] = ccount + 1, cbytes + size
+                    if len(largest) < top:
+                        heapq.heappush(largest, (size, oid, name))
+                    elif top and (size, oid) > largest[0][:2]:
+                        heapq.heapreplace(largest, (size, oid, name))
+
+        byoid = {}
+        with self._lock:
+            keys = list(self._conflict_cache)
+        for oid, serial in keys:
+            byoid[oid] = byoid.get(oid, 0) + 1
+        revisions = {}
+        for n in byoid.values():
+            revisions[n] = revisions.get(n, 0) + 1
+        most_revised = heapq.nlargest(
+            top, ((n, oid) for oid, n in byoid.items()))
+
+        return {
+            'count': count,
+            'bytes': nbytes,
+            'size_histogram': size_histogram,
+            'largest': sorted(largest, reverse=True),
+            'classes': classes,
+            'refcounts': refcounts,
+            'revisions': revisions,
+            'most_revised': most_revised,
+        }
+
     def getSize(self):
         return 0
 
@@ -123,10 +555,10 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
             # gc entries but keep latest record for each oid
             for oid, hist in byoid.items():
                 hist.sort(key=lambda _: _[0])  # by serial
-                hist = hist[:-1]  # without latest record
-                for serial, data, t in hist:
+                for (serial, data, t), nxt in zip(hist, hist[1:]):
                     if now > (t + self._conflict_cache_maxage):
                         del self._conflict_cache[(oid, serial)]
+                        self._forgetRevision(oid, serial, nxt[0], data)
 
             self._last_cache_gc = now
         self._tmp = []
@@ -190,6 +622,11 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
         """
         # implementation stolen from ZODB.test_storage.MinimalMemoryStorage
         with self._lock:
+            # revisions set aside for snapshots know when they ended
+            for start_tid, end_tid, data in self._pinned_revisions.get(
+                    oid, ()):
+                if start_tid < tid <= end_tid:
+                    return data, start_tid, end_tid
             tids = [stid for soid, stid in self._conflict_cache if soid == oid]
             if not tids:
                 raise POSException.POSKeyError(oid)
@@ -215,8 +652,7 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
             if oid in self._index:
                 oserial = self._index[oid]
                 if serial != oserial:
-                    newdata = self.tryToResolveConflict(
-                        oid, oserial, serial, data)
+                    newdata = self._resolveConflict(oid, oserial, serial, data)
                     if not newdata:
                         raise POSException.ConflictError(
                             oid=oid,
@@ -228,6 +664,90 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
                 oserial = serial
             self._tmp.append((oid, data))
 
+    def _resolveConflict(self, oid, oserial, serial, data, marker=[]):
+        # A retry sending the very same state gets the earlier outcome.
+        cache = self._resolution_cache
+        key = (oid, oserial, serial, data)
+        newdata = cache.getOutcome(key, marker)
+        if newdata is marker:
+            try:
+                newdata = self.tryToResolveConflict(oid, oserial, serial, data)
+            except POSException.ConflictError as e:
+                cache.putOutcome(key, (e.__class__, e.args, dict(e.__dict__)))
+                raise
+            cache.putOutcome(key, newdata)
+        elif isinstance(newdata, tuple):
+            # report the same conflict as the first attempt did
+            klass, args, attrs = newdata
+            error = klass(*args)
+            error.__dict__.update(attrs)
+            raise error
+        return newdata
+
+    def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
+                             committedData=b''):
+        """ Resolve a conflict like ConflictResolvingStorage does
+
+        The committed and old states are taken from the resolution cache
+        rather than unpickled for every conflicting writer.
+        """
+        klass = 'n/a'
+        try:
+            prfactory = self._resolution_cache.factory(oid)
+            file = BytesIO(self._crs_untransform_record_data(newpickle))
+            unpickler = PersistentUnpickler(
+                find_global, prfactory.persistent_load, file)
+            meta = unpickler.load()
+            if isinstance(meta, tuple):
+                klass = meta[0]
+                newargs = meta[1] or ()
+                if isinstance(klass, tuple):
+                    klass = find_global(*klass)
+            else:
+                klass = meta
+                newargs = ()
+
+            inst = klass.__new__(klass, *newargs)
+            try:
+                resolve = inst._p_resolveConflict
+            except AttributeError:
+                raise POSException.ConflictError
+
+            newstate = unpickler.load()
+            old = self._resolutionState(oid, oldSerial, prfactory)
+            committed = self._resolutionState(
+                oid, committedSerial, prfactory, committedData)
+
+            resolved = resolve(old, committed, newstate)
+
+            file = BytesIO()
+            pickler = PersistentPickler(persistent_id, file, _protocol)
+            pickler.dump(meta)
+            pickler.dump(resolved)
+            return self._crs_transform_record_data(file.getvalue())
+        except (POSException.ConflictError, BadClassName) as e:
+            logger.debug(
+                "Conflict resolution on %s failed with %s: %s",
+                klass, e.__class__.__name__, str(e))
+        except:  # noqa: E722 bare except
+            # Don't pass arbitrary exceptions back to the client, see
+            # ZODB.ConflictResolution.tryToResolveConflict.
+            logger.exception(
+                "Unexpected error while trying to resolve conflict on %s",
+                klass)
+
+        raise POSException.ConflictError(
+            oid=oid, serials=(committedSerial, oldSerial), data=newpickle)
+
+    def _resolutionState(self, oid, serial, prfactory, data=b'', marker=[]):
+        cache = self._resolution_cache
+        result = cache.getState(oid, serial, marker)
+        if result is marker:
+            result = cache.putState(
+                oid, serial, prfactory,
+                state(self, oid, serial, prfactory, data))
+        return result
+
     def _finish(self, tid, u, d, e):
         zeros = {}
         referenceCount = self._referenceCount
@@ -236,6 +756,7 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
         serial = self._tid
         index = self._index
         opickle = self._opickle
+        changed = {}
         self._ltid = tid
 
         # iterate over all the objects touched by/created within this
@@ -296,6 +817,12 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
             opickle[oid] = data
             now = time.time()
             self._conflict_cache[(oid, serial)] = data, now
+            changed[oid] = 1
+
+        invalidations = self._invalidations
+        if len(invalidations) == invalidations.maxlen:
+            self._invalidations_floor = invalidations[0][0]
+        invalidations.append((tid, tuple(changed)))
 
         if zeros:
             for oid in zeros.keys():
@@ -328,10 +855,13 @@ class TemporaryStorage(BaseStorage, ConflictResolvingStorage):
         except Exception:
             pass
 
-        # remove this object from the conflict cache if it exists there
-        for k in list(self._conflict_cache.keys()):
-            if k[0] == oid:
-                del self._conflict_cache[k]
+        # remove this object from the conflict cache if it exists there,
+        # setting aside the revisions still seen by snapshots; the last
+        # revision ends with the transaction collecting the object
+        serials = sorted(k[1] for k in self._conflict_cache if k[0] == oid)
+        for serial, end in zip(serials, serials[1:] + [self._ltid]):
+            data, t = self._conflict_cache.pop((oid, serial))
+            self._forgetRevision(oid, serial, end, data)
 
         # Remove/decref references
         roids = self._oreferences.get(oid, [])
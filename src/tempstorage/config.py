@@ -19,4 +19,6 @@ class TemporaryStorage(BaseConfig):
 
     def open(self):
         from tempstorage.TemporaryStorage import TemporaryStorage
-        return TemporaryStorage(self.config.name)
+        return TemporaryStorage(
+            self.config.name,
+            resolution_cache_size=self.config.conflict_resolution_cache_size)
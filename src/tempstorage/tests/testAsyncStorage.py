@@ -0,0 +1,175 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import asyncio
+import threading
+import unittest
+
+from ZODB import POSException
+from ZODB.tests.MinPO import MinPO
+from ZODB.tests.StorageTestBase import zodb_pickle
+from ZODB.utils import p64
+from ZODB.utils import u64
+from ZODB.utils import z64
+
+
+class AsyncTemporaryStorageTests(unittest.IsolatedAsyncioTestCase):
+
+    def _getTargetClass(self):
+        from tempstorage.AsyncStorage import AsyncTemporaryStorage
+        return AsyncTemporaryStorage
+
+    def _makeOne(self):
+        from tempstorage.TemporaryStorage import TemporaryStorage
+        storage = TemporaryStorage('foo')
+        facade = self._getTargetClass()(storage)
+        self.addAsyncCleanup(facade.close)
+        return storage, facade
+
+    async def test_store_and_load(self):
+        storage, facade = self._makeOne()
+        oid = await facade.new_oid()
+        data = zodb_pickle(MinPO(1))
+        tid = await facade.store(oid, z64, data)
+        self.assertEqual(tid, storage.lastTransaction())
+        self.assertEqual(await facade.load(oid), (data, tid))
+
+    async def test_commit_and_loadBefore(self):
+        storage, facade = self._makeOne()
+        oid1 = await facade.new_oid()
+        oid2 = await facade.new_oid()
+        data1 = zodb_pickle(MinPO(1))
+        data2 = zodb_pickle(MinPO(2))
+        tid1 = await facade.commit([(oid1, z64, data1), (oid2, z64, data2)])
+        self.assertEqual(await facade.load(oid2), (data2, tid1))
+        data3 = zodb_pickle(MinPO(3))
+        tid2 = await facade.store(oid1, tid1, data3)
+        self.assertEqual(await facade.loadBefore(oid1, tid2),
+                         (data1, tid1, tid2))
+        self.assertEqual(
+            await facade.loadBefore(oid1, p64(u64(tid2) + 1)),
+            (data3, tid2, None))
+
+    async def test_commit_conflict(self):
+        storage, facade = self._makeOne()
+        oid = await facade.new_oid()
+        tid = await facade.store(oid, z64, zodb_pickle(MinPO(1)))
+        await facade.store(oid, tid, zodb_pickle(MinPO(2)))
+        with self.assertRaises(POSException.ConflictError):
+            await facade.store(oid, tid, zodb_pickle(MinPO(3)))
+        # the failed commit was aborted, so the storage is usable again
+        await facade.store(oid, storage.lastTransaction(),
+                           zodb_pickle(MinPO(4)))
+
+    async def test_concurrent_loads_coalesced(self):
+        storage, facade = self._makeOne()
+        oid = await facade.new_oid()
+        data = zodb_pickle(MinPO(1))
+        tid = await facade.store(oid, z64, data)
+
+        calls = []
+        release = threading.Event()
+        original = storage.load
+
+        def load(oid, version=''):
+            calls.append(oid)
+            release.wait(5)
+            return original(oid, version)
+
+        storage.load = load
+        first = asyncio.ensure_future(facade.load(oid))
+        second = asyncio.ensure_future(facade.load(oid))
+        await asyncio.sleep(0.1)
+        release.set()
+        self.assertEqual(await first, (data, tid))
+        self.assertEqual(await second, (data, tid))
+        self.assertEqual(calls, [oid])
+        self.assertEqual(facade._pending, {})
+
+    async def test_cancelled_waiter_does_not_cancel_shared_load(self):
+        storage, facade = self._makeOne()
+        oid = await facade.new_oid()
+        data = zodb_pickle(MinPO(1))
+        tid = await facade.store(oid, z64, data)
+
+        release = threading.Event()
+        original = storage.load
+
+        def load(oid, version=''):
+            release.wait(5)
+            return original(oid, version)
+
+        storage.load = load
+        first = asyncio.ensure_future(facade.load(oid))
+        second = asyncio.ensure_future(facade.load(oid))
+        await asyncio.sleep(0.1)
+        first.cancel()
+        release.set()
+        self.assertEqual(await second, (data, tid))
+
+    async def test_commit_forgets_pending_reads_of_committed_oids(self):
+        storage, facade = self._makeOne()
+        oid = await facade.new_oid()
+        other = await facade.new_oid()
+        tid = await facade.commit([(oid, z64, zodb_pickle(MinPO(1))),
+                                   (other, z64, zodb_pickle(MinPO(2)))])
+
+        release = threading.Event()
+        original = storage.loadBefore
+
+        def loadBefore(oid, tid):
+            release.wait(5)
+            return original(oid, tid)
+
+        storage.loadBefore = loadBefore
+        after = p64(u64(tid) + 10)
+        reads = [asyncio.ensure_future(facade.loadBefore(oid, after)),
+                 asyncio.ensure_future(facade.load(oid)),
+                 asyncio.ensure_future(facade.loadBefore(other, after))]
+        await asyncio.sleep(0.1)
+        await facade.store(oid, tid, zodb_pickle(MinPO(3)))
+        self.assertEqual(list(facade._pending),
+                         [('loadBefore', other, after)])
+        release.set()
+        await asyncio.gather(*reads)
+
+    async def test_close_does_not_block_event_loop(self):
+        storage, facade = self._makeOne()
+        oid = await facade.new_oid()
+        release = threading.Event()
+        original = storage.store
+
+        def store(*args):
+            release.wait(5)
+            return original(*args)
+
+        storage.store = store
+        commit = asyncio.ensure_future(
+            facade.store(oid, z64, zodb_pickle(MinPO(1))))
+        await asyncio.sleep(0.1)
+        close = asyncio.ensure_future(facade.close())
+        # the loop keeps running while close waits for the commit
+        await asyncio.sleep(0.1)
+        self.assertFalse(close.done())
+        release.set()
+        await commit
+        await close
+        self.assertEqual(storage.load(oid)[1], storage.lastTransaction())
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            AsyncTemporaryStorageTests),
+    ))
@@ -254,6 +254,419 @@ class TemporaryStorageTests(unittest.TestCase):
         self.assertEqual(loads, exs)
         self.assertEqual(exv, '')
 
+    def test_lastInvalidations(self):
+        from ZODB.tests.MinPO import MinPO
+        storage = self._makeOne()
+        self.assertEqual(storage.lastInvalidations(10), [])
+        oid1 = storage.new_oid()
+        self._dostore(storage, oid1, data=MinPO(1))
+        rev1 = storage.lastTransaction()
+        oid2 = storage.new_oid()
+        self._dostore(storage, oid2, data=MinPO(2))
+        rev2 = storage.lastTransaction()
+        self._dostore(storage, oid1, revid=rev1, data=MinPO(3))
+        rev3 = storage.lastTransaction()
+        self.assertEqual(storage.lastInvalidations(10),
+                         [(rev1, [oid1]), (rev2, [oid2]), (rev3, [oid1])])
+        self.assertEqual(storage.lastInvalidations(1), [(rev3, [oid1])])
+        self.assertEqual(storage.lastInvalidations(0), [])
+
+    def test_getInvalidations(self):
+        from ZODB.tests.MinPO import MinPO
+        from ZODB.utils import z64
+        storage = self._makeOne()
+        self.assertEqual(storage.getInvalidations(z64), (z64, []))
+        oid1 = storage.new_oid()
+        self._dostore(storage, oid1, data=MinPO(1))
+        rev1 = storage.lastTransaction()
+        oid2 = storage.new_oid()
+        self._dostore(storage, oid2, data=MinPO(2))
+        rev2 = storage.lastTransaction()
+        self._dostore(storage, oid1, revid=rev1, data=MinPO(3))
+        rev3 = storage.lastTransaction()
+        ltid, oids = storage.getInvalidations(z64)
+        self.assertEqual(ltid, rev3)
+        self.assertEqual(sorted(oids), sorted([oid1, oid2]))
+        self.assertEqual(storage.getInvalidations(rev2), (rev3, [oid1]))
+        self.assertEqual(storage.getInvalidations(rev3), (rev3, []))
+
+    def test_getInvalidations_forgotten(self):
+        from collections import deque
+
+        from ZODB.tests.MinPO import MinPO
+        from ZODB.utils import z64
+        storage = self._makeOne()
+        storage._invalidations = deque(maxlen=2)
+        oid = storage.new_oid()
+        self._dostore(storage, oid, data=MinPO(1))
+        rev1 = storage.lastTransaction()
+        self._dostore(storage, oid, revid=rev1, data=MinPO(2))
+        rev2 = storage.lastTransaction()
+        self._dostore(storage, oid, revid=rev2, data=MinPO(3))
+        rev3 = storage.lastTransaction()
+        self.assertEqual([tid for tid, oids in storage.lastInvalidations(5)],
+                         [rev2, rev3])
+        # rev1's changes are forgotten, so clients older than it must flush
+        self.assertEqual(storage.getInvalidations(z64), None)
+        self.assertEqual(storage.getInvalidations(rev1), (rev3, [oid]))
+
+    def test_getObjectStatistics(self):
+        from ZODB.tests.MinPO import MinPO
+        storage = self._makeOne()
+        oid1 = storage.new_oid()
+        self._dostore(storage, oid1, data=MinPO(1))
+        rev1 = storage.lastTransaction()
+        self._dostore(storage, oid1, revid=rev1, data=MinPO('x' * 1000))
+        oid2 = storage.new_oid()
+        self._dostore(storage, oid2, data=MinPO(2))
+        size1 = len(storage._opickle[oid1])
+        size2 = len(storage._opickle[oid2])
+
+        stats = storage.getObjectStatistics(top=1, batch=1)
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['bytes'], size1 + size2)
+        self.assertEqual(sum(stats['size_histogram'].values()), 2)
+        for bound in stats['size_histogram']:
+            self.assertEqual(bound & (bound - 1), 0)
+        self.assertEqual(stats['largest'],
+                         [(size1, oid1, 'ZODB.tests.MinPO.MinPO')])
+        self.assertEqual(stats['classes'],
+                         {'ZODB.tests.MinPO.MinPO': (2, size1 + size2)})
+        self.assertEqual(stats['refcounts'], {0: 2})
+        self.assertEqual(stats['revisions'], {1: 1, 2: 1})
+        self.assertEqual(stats['most_revised'], [(2, oid1)])
+
+    def test_getObjectStatistics_empty(self):
+        storage = self._makeOne()
+        stats = storage.getObjectStatistics()
+        self.assertEqual(stats['count'], 0)
+        self.assertEqual(stats['largest'], [])
+        self.assertEqual(stats['most_revised'], [])
+
+    def _store_conflicting(self, storage, oid, serial, data):
+        from ZODB.Connection import TransactionMetaData
+        t = TransactionMetaData()
+        storage.tpc_begin(t)
+        try:
+            storage.store(oid, serial, data, '', t)
+            return storage._tmp[-1][1]
+        finally:
+            storage.tpc_abort(t)
+
+    def test_conflict_resolution_cache(self):
+        from ZODB.tests.ConflictResolution import PCounter
+        storage = self._makeOne()
+        oid = storage.new_oid()
+        obj = PCounter()
+        obj.inc()
+        self._dostore(storage, oid, data=obj)
+        rev1 = storage.lastTransaction()
+        obj.inc()
+        self._dostore(storage, oid, revid=rev1, data=obj)
+        obj.inc(5)
+        data = StorageTestBase.zodb_pickle(obj)
+
+        resolved = self._store_conflicting(storage, oid, rev1, data)
+        self.assertEqual(StorageTestBase.zodb_unpickle(resolved)._value, 8)
+        self.assertEqual(storage.getConflictResolutionStatistics(), {
+            'hits': 0, 'misses': 2, 'size': 2,
+            'outcome_hits': 0, 'outcome_misses': 1, 'outcomes': 1})
+
+        # another writer starting from rev1 reuses the unpickled states
+        obj.inc(10)
+        other = StorageTestBase.zodb_pickle(obj)
+        resolved = self._store_conflicting(storage, oid, rev1, other)
+        self.assertEqual(StorageTestBase.zodb_unpickle(resolved)._value, 18)
+        stats = storage.getConflictResolutionStatistics()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+
+        # the same writer retrying gets the earlier outcome
+        storage.tryToResolveConflict = None  # must not be called again
+        self.assertEqual(
+            self._store_conflicting(storage, oid, rev1, other), resolved)
+        stats = storage.getConflictResolutionStatistics()
+        self.assertEqual((stats['outcome_hits'], stats['outcomes']), (1, 2))
+
+    def test_conflict_resolution_cache_concurrent_writers(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.tests.ConflictResolution import PCounter
+        storage = self._makeOne()
+        db = DB(storage)
+        tm = transaction.TransactionManager()
+        root = db.open(transaction_manager=tm).root()
+        root['counter'] = PCounter()
+        root['counter'].inc(0)
+        tm.commit()
+
+        for round in range(3):
+            writers = []
+            for i in range(3):
+                wtm = transaction.TransactionManager()
+                counter = db.open(transaction_manager=wtm).root()['counter']
+                counter.inc()
+                writers.append((wtm, counter._p_jar))
+            for wtm, conn in writers:
+                wtm.commit()
+                conn.close()
+
+        tm.begin()
+        self.assertEqual(root['counter']._value, 9)
+        stats = storage.getConflictResolutionStatistics()
+        # each round, the second and third writer conflict from the same
+        # old state
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 9)
+        db.close()
+
+    def test_conflict_resolution_cache_unresolvable(self):
+        from ZODB import POSException
+        from ZODB.tests.MinPO import MinPO
+        storage = self._makeOne()
+        oid = storage.new_oid()
+        self._dostore(storage, oid, data=MinPO(1))
+        rev1 = storage.lastTransaction()
+        self._dostore(storage, oid, revid=rev1, data=MinPO(2))
+        data = StorageTestBase.zodb_pickle(MinPO(3))
+
+        class ResolverConflictError(POSException.ConflictError):
+            pass
+
+        def tryToResolveConflict(*args):
+            raise ResolverConflictError('no way')
+
+        storage.tryToResolveConflict = tryToResolveConflict
+        errors = []
+        for i in range(2):
+            with self.assertRaises(ResolverConflictError) as cm:
+                self._store_conflicting(storage, oid, rev1, data)
+            self.assertIn('no way', str(cm.exception))
+            errors.append(cm.exception)
+        # every hit raises a new error
+        self.assertIsNot(errors[0], errors[1])
+        stats = storage.getConflictResolutionStatistics()
+        self.assertEqual((stats['outcome_hits'], stats['outcome_misses']),
+                         (1, 1))
+
+    def test_conflict_resolution_cache_is_bounded(self):
+        from tempstorage.TemporaryStorage import ConflictResolutionCache
+        cache = ConflictResolutionCache(2)
+        cache.putOutcome('a', 1)
+        cache.putOutcome('b', 2)
+        self.assertEqual(cache.getOutcome('a'), 1)
+        cache.putOutcome('c', 3)
+        self.assertEqual(cache.getOutcome('b'), None)
+        self.assertEqual(cache.getOutcome('a'), 1)
+        self.assertEqual(cache.getOutcome('c'), 3)
+        self.assertEqual((cache.outcome_hits, cache.outcome_misses), (3, 1))
+
+        f1 = cache.factory(b'1')
+        cache.putState(b'1', b's1', f1, {'v': 1})
+        cache.putState(b'1', b's2', f1, {'v': 2})
+        f2 = cache.factory(b'2')
+        cache.putState(b'2', b's1', f2, {'v': 3})
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.getState(b'1', b's1'), None)
+        self.assertEqual(cache.getState(b'1', b's2'), {'v': 2})
+        self.assertIs(cache.factory(b'1'), f1)
+
+        disabled = ConflictResolutionCache(0)
+        disabled.putOutcome('a', 1)
+        disabled.putState(b'1', b's1', disabled.factory(b'1'), {})
+        self.assertEqual(len(disabled), 0)
+        self.assertEqual(len(disabled._outcomes), 0)
+
+    def test_conflict_resolution_cache_is_pluggable(self):
+        from tempstorage.TemporaryStorage import ConflictResolutionCache
+        cache = ConflictResolutionCache(5)
+        storage = self._getTargetClass()('foo', resolution_cache=cache)
+        self.assertIs(storage._resolution_cache, cache)
+        storage = self._getTargetClass()('foo', resolution_cache_size=0)
+        self.assertEqual(storage._resolution_cache.size, 0)
+
+    def test_conflict_resolution_cache_size_config(self):
+        import ZODB.config
+        storage = ZODB.config.storageFromString("""
+            %import tempstorage
+            <temporarystorage>
+              name bar
+              conflict-resolution-cache-size 7
+            </temporarystorage>
+            """)
+        self.assertEqual(storage.getName(), 'bar')
+        self.assertEqual(storage._resolution_cache.size, 7)
+        storage = ZODB.config.storageFromString("""
+            %import tempstorage
+            <temporarystorage>
+            </temporarystorage>
+            """)
+        self.assertEqual(storage._resolution_cache.size, 100)
+
+    def test_conflict_resolution_cache_copies_states(self):
+        from ZODB.ConflictResolution import PersistentReference
+
+        from tempstorage.TemporaryStorage import ConflictResolutionCache
+        cache = ConflictResolutionCache()
+        factory = cache.factory(b'1')
+        ref = factory.persistent_load(b'\0' * 8)
+        self.assertIsInstance(ref, PersistentReference)
+        copied = cache.putState(b'1', b's1', factory, {'v': [1], 'ref': ref})
+        copied['v'].append(2)
+        state = cache.getState(b'1', b's1')
+        self.assertEqual(state['v'], [1])
+        # references are shared, not copied
+        self.assertIs(state['ref'], ref)
+
+    def test_snapshot_keeps_expired_revisions(self):
+        from ZODB import POSException
+        from ZODB.tests.MinPO import MinPO
+        storage = self._makeOne()
+        storage._conflict_cache_gcevery = -1
+        storage._conflict_cache_maxage = -1
+        oid = storage.new_oid()
+        self._dostore(storage, oid, data=MinPO(1))
+        rev1 = storage.lastTransaction()
+        data1 = storage._opickle[oid]
+        snapshot = storage.snapshot()
+        self.assertEqual(snapshot.tid, rev1)
+        self._dostore(storage, oid, revid=rev1, data=MinPO(2))
+        rev2 = storage.lastTransaction()
+        self._dostore(storage, oid, revid=rev2, data=MinPO(3))
+        rev3 = storage.lastTransaction()
+
+        # rev1 and rev2 expired, but rev1 is kept aside for the snapshot
+        self.assertEqual(set(storage._conflict_cache), {(oid, rev3)})
+        self.assertEqual(snapshot.load(oid), (data1, rev1))
+        # loadBefore sees the revision kept for the snapshot, but not the
+        # forgotten rev2
+        self.assertEqual(storage.loadBefore(oid, rev2), (data1, rev1, rev2))
+        self.assertEqual(storage.loadBefore(oid, rev3), None)
+        self.assertRaises(POSException.ConflictError,
+                          storage.loadSerial, oid, rev1)
+        self.assertEqual(storage.getPinnedStatistics(), {
+            'pins': {rev1: 1},
+            'revisions': 1,
+            'bytes': len(data1),
+            'bytes_by_tid': {rev1: len(data1)},
+        })
+
+        snapshot.release()
+        self.assertEqual(storage.getPinnedStatistics()['bytes'], 0)
+        self._dostore(storage, oid, revid=rev3, data=MinPO(4))
+        rev4 = storage.lastTransaction()
+        self.assertEqual(set(storage._conflict_cache), {(oid, rev4)})
+
+    def test_snapshot_keeps_garbage_collected_revisions(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.tests.MinPO import MinPO
+        storage = self._makeOne()
+        db = DB(storage)
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        root = conn.root()
+        root['child'] = child = MinPO(1)
+        tm.commit()
+        oid = child._p_oid
+        data = storage._opickle[oid]
+
+        with storage.snapshot() as snapshot:
+            del root['child']
+            tm.commit()
+            self.assertNotIn(oid, storage._opickle)
+            self.assertEqual(snapshot.load(oid), (data, child._p_serial))
+            stats = storage.getPinnedStatistics()
+            self.assertEqual(stats['revisions'], 1)
+            self.assertEqual(stats['bytes'], len(data))
+
+        self.assertEqual(storage._pinned_revisions, {})
+        self.assertEqual(storage.getPinnedStatistics()['pins'], {})
+        db.close()
+
+    def test_snapshot_sees_unexpired_revisions(self):
+        from ZODB import POSException
+        from ZODB.tests.MinPO import MinPO
+        storage = self._makeOne()
+        oid = storage.new_oid()
+        self._dostore(storage, oid, data=MinPO(1))
+        rev1 = storage.lastTransaction()
+        data1 = storage._opickle[oid]
+        with storage.snapshot() as snapshot:
+            self._dostore(storage, oid, revid=rev1, data=MinPO(2))
+            self.assertEqual(snapshot.load(oid), (data1, rev1))
+            self.assertRaises(POSException.POSKeyError,
+                              snapshot.load, storage.new_oid())
+            self.assertEqual(storage.getPinnedStatistics()['revisions'], 0)
+
+    def test_snapshot_releases_garbage_of_overlapping_snapshots(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.tests.MinPO import MinPO
+        storage = self._makeOne()
+        db = DB(storage)
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        root = conn.root()
+        root['child'] = MinPO(0)
+        tm.commit()
+        snapshot = storage.snapshot()
+        for i in range(1, 6):
+            root['child'] = MinPO(i)
+            tm.commit()
+            previous, snapshot = snapshot, storage.snapshot()
+            previous.release()
+        # the only snapshot left sees none of the replaced children
+        stats = storage.getPinnedStatistics()
+        self.assertEqual(stats['revisions'], 0)
+        self.assertEqual(stats['bytes_by_tid'], {snapshot.tid: 0})
+        self.assertEqual(storage._pinned_revisions, {})
+        snapshot.release()
+        db.close()
+
+    def test_snapshot_read_by_historical_connection(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.tests.MinPO import MinPO
+        from ZODB.utils import p64
+        from ZODB.utils import u64
+        storage = self._makeOne()
+        storage._conflict_cache_gcevery = -1
+        storage._conflict_cache_maxage = -1
+        db = DB(storage)
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        root = conn.root()
+        root['x'] = MinPO(0)
+        tm.commit()
+        snapshot = storage.snapshot()
+        for i in range(1, 4):
+            root['x'].value = i
+            tm.commit()
+        self.assertEqual(storage.getPinnedStatistics()['revisions'], 1)
+
+        # DB.open(at=...) reads revisions before the tid after the pinned one
+        at = p64(u64(snapshot.tid) + 1)
+        historical = db.open(at=snapshot.tid)
+        self.assertEqual(historical.root()['x'].value, 0)
+        self.assertEqual(storage.loadBefore(root['x']._p_oid, at)[1],
+                         snapshot.tid)
+        historical.close()
+        snapshot.release()
+        db.close()
+
+    def test_snapshot_released(self):
+        from ZODB.tests.MinPO import MinPO
+
+        from tempstorage.TemporaryStorage import TemporaryStorageError
+        storage = self._makeOne()
+        oid = storage.new_oid()
+        self._dostore(storage, oid, data=MinPO(1))
+        snapshot = storage.snapshot()
+        snapshot.release()
+        snapshot.release()
+        self.assertEqual(storage._pins, {})
+        self.assertRaises(TemporaryStorageError, snapshot.load, oid)
+
 
 def test_suite():
     return unittest.TestSuite((